@@ -1,126 +1,970 @@
 # chat_history.py
 
 import os
+import re
+import sys
 import time
+import asyncio
 import json
-from datetime import datetime
+import random
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+import numpy as np
 from dotenv import load_dotenv
-from openai import OpenAI
-from anthropic import Anthropic
-import google.generativeai as genai
-from elasticsearch import Elasticsearch
-from typing import Optional, Dict, Any, List
+from elasticsearch import Elasticsearch, helpers
+from elasticsearch.serializer import NdjsonSerializer, OrjsonSerializer
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator
 
 load_dotenv()
 
-# Initialize clients
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-anthropic_client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+logger = logging.getLogger(__name__)
 
+# Provider SDKs are imported and their clients built on first use, so tools
+# that never touch a provider don't pay for loading it
+_openai_client = None
+_async_openai_client = None
+_anthropic_client = None
+_genai_module = None
+
+def _openai():
+    global _openai_client
+    if _openai_client is None:
+        from openai import OpenAI
+        # Retries are left to _embeddings_request so the rate limiter sees every 429
+        _openai_client = OpenAI(api_key=os.getenv(PROFILES["openai"].api_key_env), max_retries=0)
+    return _openai_client
+
+def _async_openai():
+    global _async_openai_client
+    if _async_openai_client is None:
+        from openai import AsyncOpenAI
+        # Retries are left to _call_provider so the rate limiter sees every 429
+        _async_openai_client = AsyncOpenAI(
+            api_key=os.getenv(PROFILES["openai"].api_key_env), max_retries=0
+        )
+    return _async_openai_client
+
+def _anthropic():
+    global _anthropic_client
+    if _anthropic_client is None:
+        from anthropic import AsyncAnthropic
+        _anthropic_client = AsyncAnthropic(
+            api_key=os.getenv(PROFILES["anthropic"].api_key_env), max_retries=0
+        )
+    return _anthropic_client
+
+def _genai():
+    global _genai_module
+    if _genai_module is None:
+        import google.generativeai as genai
+        genai.configure(api_key=os.getenv(PROFILES["google"].api_key_env))
+        _genai_module = genai
+    return _genai_module
+
+_embedding_encoding = None
+
+def _tokenizer():
+    global _embedding_encoding
+    if _embedding_encoding is None:
+        import tiktoken
+        _embedding_encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+    return _embedding_encoding
+
+class _OrjsonNdjsonSerializer(OrjsonSerializer, NdjsonSerializer):
+    mimetype = "application/x-ndjson"
+
+# orjson writes float32 arrays in their shortest float32 repr; tolist() widens to
+# float64 and nearly doubles every vector in index, bulk and msearch bodies
+ES_SERIALIZERS = {
+    OrjsonSerializer.mimetype: OrjsonSerializer(),
+    _OrjsonNdjsonSerializer.mimetype: _OrjsonNdjsonSerializer()
+}
+
+# Shared by every caller (including the MCP server) so connections are reused
 es = Elasticsearch(
     os.getenv("ELASTICSEARCH_URL"),
-    api_key=os.getenv("ELASTICSEARCH_API_KEY")
+    api_key=os.getenv("ELASTICSEARCH_API_KEY"),
+    serializers=ES_SERIALIZERS,
+    # Vector-heavy JSON bodies gzip several-fold
+    http_compress=True,
+    connections_per_node=25,
+    sniff_on_start=False,
+    request_timeout=10,
+    retry_on_timeout=True,
+    max_retries=3
 )
 
+# Chats re-embedded per scroll page during migrate_index; ~500 texts stays well
+# inside a minute of the embeddings TPM budget
+MIGRATION_BATCH_SIZE = 256
+MIGRATION_SCROLL = "30m"
+
+# Bulk writes and migrations carry far more than a single search or index call
+BULK_REQUEST_TIMEOUT = 120
+
+_async_es_client = None
+
+def _async_es():
+    global _async_es_client
+    if _async_es_client is None:
+        from elasticsearch import AsyncElasticsearch
+        _async_es_client = AsyncElasticsearch(
+            os.getenv("ELASTICSEARCH_URL"),
+            api_key=os.getenv("ELASTICSEARCH_API_KEY"),
+            serializers=ES_SERIALIZERS,
+            http_compress=True,
+            connections_per_node=25,
+            request_timeout=10,
+            retry_on_timeout=True,
+            max_retries=3
+        )
+    return _async_es_client
+
+async def _close_async_clients():
+    # Async clients hold connection pools bound to the event loop that created
+    # them; drop them so the next loop builds fresh ones
+    global _async_openai_client, _anthropic_client, _async_es_client
+    clients = [_async_openai_client, _anthropic_client, _async_es_client]
+    _async_openai_client = _anthropic_client = _async_es_client = None
+    for client in clients:
+        if client is not None:
+            await client.close()
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Matryoshka-truncated server-side; a third of the bytes of ada-002's 1536 dims
+EMBEDDING_DIMENSIONS = 512
+# OpenAI accepts at most 2048 inputs per embeddings request
+EMBEDDING_BATCH_SIZE = 2048
+# Per-request token budget (kept under the TPM limit) and per-input model limit
+EMBEDDING_BATCH_MAX_TOKENS = 200_000
+EMBEDDING_INPUT_MAX_TOKENS = 8191
+# Shared per-minute budget across all concurrent embedding requests
+EMBEDDING_RPM = 3000
+EMBEDDING_TPM = 250_000
+
+def _pack_embedding_batches(texts: List[str]):
+    # Greedily packs texts into requests that respect both the input-count and
+    # token budgets, yielding (original positions, texts, token count) per
+    # request. Inputs over the model's limit are clipped to their leading tokens.
+    encoding = _tokenizer()
+    positions, batch, batch_tokens = [], [], 0
+    for i, text in enumerate(texts):
+        tokens = encoding.encode(text)
+        if len(tokens) > EMBEDDING_INPUT_MAX_TOKENS:
+            tokens = tokens[:EMBEDDING_INPUT_MAX_TOKENS]
+            text = encoding.decode(tokens)
+        if batch and (len(batch) == EMBEDDING_BATCH_SIZE
+                      or batch_tokens + len(tokens) > EMBEDDING_BATCH_MAX_TOKENS):
+            yield positions, batch, batch_tokens
+            positions, batch, batch_tokens = [], [], 0
+        positions.append(i)
+        batch.append(text)
+        batch_tokens += len(tokens)
+    if batch:
+        yield positions, batch, batch_tokens
+
+# Concurrent indexing: pairs per embeddings request and max requests in flight
+INDEX_SUB_BATCH_SIZE = 512
+INDEX_MAX_CONCURRENT_BATCHES = 4
+
+@dataclass(frozen=True)
+class ProviderProfile:
+    name: str
+    model: str
+    # Starting request/token budgets per minute
+    rpm: int
+    tpm: int
+    # Max in-flight completion requests
+    max_concurrent: int
+    # Expected end-to-end latency for a completion
+    l_target_ms: int
+    api_key_env: str
+    retryable: Tuple[int, ...] = (429, 500, 502, 503, 504)
+
+PROFILES = {
+    "openai": ProviderProfile("openai", "gpt-4", 60, 150_000, 10, 2000, "OPENAI_API_KEY"),
+    "anthropic": ProviderProfile("anthropic", "claude-3-5-sonnet-20241022", 50, 80_000, 5, 3000, "ANTHROPIC_API_KEY"),
+    "google": ProviderProfile("google", "gemini-pro", 60, 100_000, 8, 2000, "GOOGLE_API_KEY"),
+}
+
+RATE_LIMIT_MAX_RETRIES = 3
+# Rough output allowance used when estimating a completion's token cost
+COMPLETION_TOKEN_ESTIMATE = 1000
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def _status_code(exc: Exception) -> Optional[int]:
+    # openai/anthropic errors carry status_code; google.api_core errors carry code
+    for attr in ("status_code", "code"):
+        code = getattr(exc, attr, None)
+        if isinstance(code, int):
+            return code
+    return None
+
+def _response_headers(exc: Exception):
+    response = getattr(exc, "response", None)
+    return getattr(response, "headers", None) or {}
+
+def _parse_reset(value: str) -> Optional[float]:
+    # OpenAI reset headers are Go-style durations such as "20ms", "1s" or "6m0s"
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * scale[unit] for amount, unit in parts)
+
+def _retry_after_seconds(exc: Exception) -> Optional[float]:
+    headers = _response_headers(exc)
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    # Otherwise wait for whichever budget is actually exhausted to replenish
+    resets = []
+    for budget in ("requests", "tokens"):
+        reset = headers.get(f"x-ratelimit-reset-{budget}")
+        if reset and headers.get(f"x-ratelimit-remaining-{budget}") == "0":
+            resets.append(_parse_reset(reset))
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+def _reported_limits(exc: Exception) -> Tuple[Optional[int], Optional[int]]:
+    # (requests, tokens) per-minute limits the provider says apply to this key
+    headers = _response_headers(exc)
+    
+    def first_int(*names):
+        for name in names:
+            try:
+                return int(headers[name])
+            except (KeyError, ValueError):
+                continue
+        return None
+    
+    return (
+        first_int("x-ratelimit-limit-requests", "anthropic-ratelimit-requests-limit"),
+        first_int("x-ratelimit-limit-tokens", "anthropic-ratelimit-tokens-limit")
+    )
+
+class RateLimiter:
+    def __init__(self, rpm: int, tpm: int, window_seconds: float = 60.0):
+        self.max_rpm = rpm
+        self.rpm = float(rpm)
+        self.tpm = tpm
+        self.window_seconds = window_seconds
+        self._requests = deque()
+        self._tokens = deque()
+        self._token_total = 0
+        self._lock = threading.Lock()
+    
+    def _prune(self, now: float):
+        cutoff = now - self.window_seconds
+        while self._requests and self._requests[0] <= cutoff:
+            self._requests.popleft()
+        while self._tokens and self._tokens[0][0] <= cutoff:
+            self._token_total -= self._tokens.popleft()[1]
+    
+    def _reserve(self, tokens: int) -> float:
+        # Returns 0 once the request is admitted, otherwise seconds to wait
+        tokens = min(tokens, self.tpm)
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            waits = []
+            if len(self._requests) >= int(self.rpm):
+                waits.append(self._requests[0] + self.window_seconds - now)
+            if self._token_total + tokens > self.tpm and self._tokens:
+                waits.append(self._tokens[0][0] + self.window_seconds - now)
+            if waits:
+                return max(max(waits), 0.01)
+            self._requests.append(now)
+            self._tokens.append((now, tokens))
+            self._token_total += tokens
+            return 0
+    
+    async def acquire(self, tokens_estimate: int = 0):
+        while (wait := self._reserve(tokens_estimate)) > 0:
+            await asyncio.sleep(wait)
+    
+    def acquire_blocking(self, tokens_estimate: int = 0):
+        # For the sync embeddings path, which runs on worker threads
+        while (wait := self._reserve(tokens_estimate)) > 0:
+            time.sleep(wait)
+    
+    def on_success(self):
+        with self._lock:
+            self.rpm = min(self.max_rpm, self.rpm + 1)
+    
+    def on_rate_limited(self, rpm_limit: Optional[int] = None, tpm_limit: Optional[int] = None):
+        with self._lock:
+            # Adopt the provider's reported limits when they're tighter than ours
+            if rpm_limit:
+                self.max_rpm = min(self.max_rpm, rpm_limit)
+            if tpm_limit:
+                self.tpm = min(self.tpm, tpm_limit)
+            self.rpm = max(1.0, min(self.rpm, self.max_rpm) * 0.5)
+
+EMBEDDING_FIELD_MAPPING = {
+    "type": "dense_vector",
+    "dims": EMBEDDING_DIMENSIONS,
+    "element_type": "float",
+    "index": True,
+    "similarity": "cosine",
+    # ES keeps the raw floats but searches int8-quantized HNSW codes
+    "index_options": {"type": "int8_hnsw", "m": 16, "ef_construction": 100}
+}
+
+INDEX_MAPPING = {
+    "mappings": {
+        "properties": {
+            "timestamp": {"type": "date"},
+            "provider": {"type": "keyword"},
+            "query": {"type": "text"},
+            "response": {"type": "text"},
+            # Embedding of the question alone; matched against search queries
+            "query_embedding": EMBEDDING_FIELD_MAPPING,
+            # Embedding of the question and answer together
+            "qa_embedding": EMBEDDING_FIELD_MAPPING
+        }
+    }
+}
+
+INDEX_TEMPLATE_NAME = "chat_history_tpl"
+
+COSINE_SCRIPT_ID = "cosine_chat"
+COSINE_SCRIPT = {
+    "lang": "painless",
+    "source": "cosineSimilarity(params.query_vector, 'query_embedding') + 1.0"
+}
+
+# Per-search time budget; timed-out searches return the partial hits found so far
+DEFAULT_LATENCY_TARGET_MS = 500
+EXACT_SEARCH_MAX_DOCS = 10_000
+KNN_MAX_CANDIDATES = 10_000
+
+# Stamps docs with the cluster's ingest time; existing timestamps (e.g. from
+# migrate_index) are left alone
+TIMESTAMP_PIPELINE_ID = "chat_ts"
+TIMESTAMP_PIPELINE_PROCESSORS = [
+    {"set": {"field": "timestamp", "value": "{{_ingest.timestamp}}", "override": False}}
+]
+
+CHAT_SOURCE_FIELDS = ["timestamp", "provider", "query", "response"]
+
+DEFAULT_CACHE_CONFIG = {"max_size": 2000, "ttl_seconds": 600, "enabled": True}
+
+# Candidates pulled from the ANN search before exact local re-ranking
+RERANK_CANDIDATES = 50
+# Local vector matrix grows in blocks of this many rows
+VECTOR_BLOCK_ROWS = 4096
+
+def cosine_topk(query: np.ndarray, matrix: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Rows of matrix are unit-normalized, so a single BLAS mat-vec gives cosines
+    scores = matrix @ (query / np.linalg.norm(query))
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return top, scores[top]
+
+class _EmbeddingCache:
+    def __init__(self, max_size: int = 2000, ttl_seconds: float = 600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def key(model: str, text: str) -> Tuple[str, bytes]:
+        return (model, hashlib.sha1(text.encode()).digest())
+    
+    def get(self, key: Tuple[str, bytes]) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def put(self, key: Tuple[str, bytes], value: np.ndarray):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, key: Tuple[str, bytes]):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def stats(self) -> Tuple[int, int, int]:
+        with self._lock:
+            return (self.hits, self.misses, self.evictions)
+
+class _LocalVectorIndex:
+    def __init__(self, dims: int):
+        self.dims = dims
+        self._rows = {}
+        self._matrix = np.empty((0, dims), dtype=np.float32)
+        self._lock = threading.Lock()
+    
+    def missing(self, ids: List[str]) -> List[str]:
+        with self._lock:
+            return [doc_id for doc_id in ids if doc_id not in self._rows]
+    
+    def add(self, ids: List[str], vectors: np.ndarray):
+        if not ids:
+            return
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        with self._lock:
+            new = [(doc_id, vec) for doc_id, vec in zip(ids, vectors) if doc_id not in self._rows]
+            needed = len(self._rows) + len(new)
+            if needed > len(self._matrix):
+                blocks = -(-needed // VECTOR_BLOCK_ROWS)
+                grown = np.empty((blocks * VECTOR_BLOCK_ROWS, self.dims), dtype=np.float32)
+                grown[:len(self._rows)] = self._matrix[:len(self._rows)]
+                self._matrix = grown
+            for doc_id, vec in new:
+                row = len(self._rows)
+                self._matrix[row] = vec
+                self._rows[doc_id] = row
+    
+    def vectors(self, ids: List[str]) -> np.ndarray:
+        with self._lock:
+            return self._matrix[[self._rows[doc_id] for doc_id in ids]]
+
 class ChatHistoryManager:
-    def __init__(self):
+    def __init__(self, cache_config: Optional[Dict[str, Any]] = None,
+                 latency_target_ms: int = DEFAULT_LATENCY_TARGET_MS):
         self.index_name = "chat_history"
-        self._ensure_index_exists()
+        self.latency_target_ms = latency_target_ms
+        config = {**DEFAULT_CACHE_CONFIG, **(cache_config or {})}
+        self._embedding_cache = None
+        if config["enabled"]:
+            self._embedding_cache = _EmbeddingCache(config["max_size"], config["ttl_seconds"])
+        self._semaphores = self._new_semaphores()
+        self._rate_limiters = {
+            name: RateLimiter(profile.rpm, profile.tpm)
+            for name, profile in PROFILES.items()
+        }
+        self._embedding_limiter = RateLimiter(EMBEDDING_RPM, EMBEDDING_TPM)
+        self._ask_handlers = {
+            "openai": self._ask_openai,
+            "anthropic": self._ask_anthropic,
+            "google": self._ask_google,
+        }
+        # Strong refs so pending index tasks aren't garbage collected mid-flight
+        self._background_tasks = set()
+        self._local_vectors = _LocalVectorIndex(EMBEDDING_DIMENSIONS)
     
-    def _ensure_index_exists(self):
+    def setup_index(self):
+        # One-time cluster setup, kept out of the constructor so startup makes no
+        # network calls and index-scoped API keys work. Every call is an idempotent
+        # PUT, so re-running it is safe.
+        # Compiled once per node and referenced by id from exact searches
+        es.put_script(id=COSINE_SCRIPT_ID, script=COSINE_SCRIPT)
+        es.ingest.put_pipeline(id=TIMESTAMP_PIPELINE_ID, processors=TIMESTAMP_PIPELINE_PROCESSORS)
+        # The index itself is auto-created with this mapping on the first write
+        es.indices.put_index_template(
+            name=INDEX_TEMPLATE_NAME,
+            index_patterns=[f"{self.index_name}*"],
+            template={
+                **INDEX_MAPPING,
+                "settings": {"index.default_pipeline": TIMESTAMP_PIPELINE_ID}
+            }
+        )
+    
+    def migrate_index(self) -> Optional[str]:
+        # Mapping changes (HNSW indexing, embedding model/dims) can't be applied
+        # in place: re-embed every doc into a fresh index and alias the old name to it
+        self.setup_index()
         if not es.indices.exists(index=self.index_name):
-            mapping = {
-                "mappings": {
-                    "properties": {
-                        "timestamp": {"type": "date"},
-                        "provider": {"type": "keyword"},
-                        "query": {"type": "text"},
-                        "response": {"type": "text"},
-                        "embedding": {
-                            "type": "dense_vector",
-                            "dims": 1536
-                        }
-                    }
+            # Fresh install: the template creates the index on first write
+            return None
+        if es.indices.exists_alias(name=self.index_name):
+            old_indices = list(es.indices.get_alias(name=self.index_name).keys())
+        else:
+            old_indices = [self.index_name]
+        target = f"{self.index_name}_{int(time.time())}"
+        
+        def actions():
+            batch = []
+            # Each batch is embedded under the shared TPM budget before the next
+            # scroll page is requested, so keep the scroll context alive well past that
+            hits = helpers.scan(
+                es, index=self.index_name, _source=CHAT_SOURCE_FIELDS,
+                size=MIGRATION_BATCH_SIZE, scroll=MIGRATION_SCROLL
+            )
+            for hit in hits:
+                batch.append(hit)
+                if len(batch) == MIGRATION_BATCH_SIZE:
+                    yield from self._migration_actions(batch, target)
+                    batch = []
+            if batch:
+                yield from self._migration_actions(batch, target)
+        
+        es.indices.create(index=target, body=INDEX_MAPPING)
+        try:
+            # The scan only sees a snapshot and the old index is dropped at the end, so
+            # reject writes during the copy rather than silently losing them
+            es.indices.put_settings(index=old_indices, settings={"index.blocks.write": True})
+            # Docs keep their _id here, so retrying a timed-out chunk is idempotent
+            helpers.bulk(es.options(request_timeout=BULK_REQUEST_TIMEOUT), actions(), refresh=True)
+        except Exception:
+            es.indices.put_settings(index=old_indices, settings={"index.blocks.write": None})
+            es.indices.delete(index=target)
+            raise
+        
+        # Single atomic swap so no write can auto-create a concrete index in between
+        es.indices.update_aliases(actions=[
+            {"add": {"index": target, "alias": self.index_name}},
+            {"remove_index": {"indices": old_indices}}
+        ])
+        return target
+    
+    def _migration_actions(self, hits: List[Dict], target: str):
+        queries = [hit["_source"]["query"] for hit in hits]
+        qa_texts = [hit["_source"]["query"] + "\n" + hit["_source"]["response"] for hit in hits]
+        embeddings = self._fetch_embeddings(queries + qa_texts)
+        for i, hit in enumerate(hits):
+            yield {
+                "_index": target,
+                "_id": hit["_id"],
+                "_source": {
+                    **hit["_source"],
+                    "query_embedding": embeddings[i],
+                    "qa_embedding": embeddings[len(hits) + i]
                 }
             }
-            es.indices.create(index=self.index_name, body=mapping)
     
-    def _get_embedding(self, text: str) -> List[float]:
-        emb = openai_client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=text
-        ).data[0].embedding
-        return emb
+    def _fetch_embeddings(self, texts: List[str]) -> np.ndarray:
+        # One float32 row per text; serialized straight from the array by ES_SERIALIZERS
+        embeddings = np.empty((len(texts), EMBEDDING_DIMENSIONS), dtype=np.float32)
+        for positions, batch, batch_tokens in _pack_embedding_batches(texts):
+            data = self._embeddings_request(batch, batch_tokens).data
+            for item in data:
+                # Results carry their input position; don't rely on response order
+                embeddings[positions[item.index]] = item.embedding
+        return embeddings
     
-    def index_chat(self, query: str, response: str, provider: str):
-        embedding = self._get_embedding(query + "\n" + response)
+    def _embeddings_request(self, batch: List[str], batch_tokens: int):
+        # Concurrent index_chats batches share this limiter, so their packed
+        # token counts together stay under the per-minute budget
+        limiter = self._embedding_limiter
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            limiter.acquire_blocking(batch_tokens)
+            try:
+                response = _openai().embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=batch,
+                    dimensions=EMBEDDING_DIMENSIONS
+                )
+            except Exception as e:
+                status = _status_code(e)
+                if status not in PROFILES["openai"].retryable or attempt == RATE_LIMIT_MAX_RETRIES:
+                    raise
+                if status == 429:
+                    limiter.on_rate_limited(*_reported_limits(e))
+                time.sleep(_retry_after_seconds(e) or 2 ** attempt + random.uniform(0, 1))
+            else:
+                limiter.on_success()
+                return response
+    
+    def _get_embeddings(self, texts: List[str], uncached: List[str] = ()) -> np.ndarray:
+        # Embeds texts followed by uncached in a single request; only texts are
+        # looked up in and stored to the cache
+        cache = self._embedding_cache
+        if cache is None:
+            return self._fetch_embeddings(list(texts) + list(uncached))
         
-        doc = {
-            "timestamp": datetime.now().isoformat(),
+        keys = [cache.key(EMBEDDING_MODEL, text) for text in texts]
+        embeddings = np.empty((len(texts) + len(uncached), EMBEDDING_DIMENSIONS), dtype=np.float32)
+        missing = []
+        for i, key in enumerate(keys):
+            cached = cache.get(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                embeddings[i] = cached
+        to_fetch = [texts[i] for i in missing] + list(uncached)
+        if to_fetch:
+            fetched = self._fetch_embeddings(to_fetch)
+            if missing:
+                embeddings[missing] = fetched[:len(missing)]
+                for i, emb in zip(missing, fetched):
+                    cache.put(keys[i], emb.copy())
+            embeddings[len(texts):] = fetched[len(missing):]
+        return embeddings
+    
+    def _get_embedding(self, text: str) -> np.ndarray:
+        return self._get_embeddings([text])[0]
+    
+    def _embed_pairs(self, pairs: List[Tuple[str, str]],
+                     cache_queries: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        # Question embeddings are usually cache hits from the search that preceded
+        # the ask. The combined Q/A text is never searched for again, so it bypasses
+        # the cache entirely rather than pushing reusable query embeddings out; both
+        # go out in one request containing only the question misses. Bulk imports
+        # skip the cache for questions too, so thousands of one-off questions don't
+        # evict the live ones
+        queries = [q for q, _ in pairs]
+        qa_texts = [q + "\n" + r for q, r in pairs]
+        if cache_queries:
+            embeddings = self._get_embeddings(queries, uncached=qa_texts)
+        else:
+            embeddings = self._get_embeddings([], uncached=queries + qa_texts)
+        return embeddings[:len(pairs)], embeddings[len(pairs):]
+    
+    def _chat_source(self, query: str, response: str, provider: str,
+                     query_embedding: np.ndarray, qa_embedding: np.ndarray) -> Dict[str, Any]:
+        # timestamp is filled in by the ingest pipeline
+        return {
             "provider": provider,
             "query": query,
             "response": response,
-            "embedding": embedding
+            "query_embedding": query_embedding,
+            "qa_embedding": qa_embedding
         }
-        es.index(index=self.index_name, document=doc)
     
-    def search_similar_chats(self, query: str, size: int = 5) -> List[Dict]:
-        query_embedding = self._get_embedding(query)
+    def index_chat(self, query: str, response: str, provider: str):
+        query_embeddings, qa_embeddings = self._embed_pairs([(query, response)])
+        doc = self._chat_source(query, response, provider, query_embeddings[0], qa_embeddings[0])
+        # New chats have no _id, so a retried write that already landed would duplicate it
+        es.options(retry_on_timeout=False).index(
+            index=self.index_name, document=doc, pipeline=TIMESTAMP_PIPELINE_ID
+        )
+    
+    def _chat_actions(self, pairs: List[Tuple[str, str]], provider: str):
+        query_embeddings, qa_embeddings = self._embed_pairs(pairs, cache_queries=False)
+        for (q, r), query_embedding, qa_embedding in zip(pairs, query_embeddings, qa_embeddings):
+            yield {
+                "_index": self.index_name,
+                "_source": self._chat_source(q, r, provider, query_embedding, qa_embedding)
+            }
+    
+    def index_chats_bulk(self, pairs: List[Tuple[str, str]], provider: str) -> int:
+        if not pairs:
+            return 0
+        
+        actions = list(self._chat_actions(pairs, provider))
+        client = es.options(retry_on_timeout=False, request_timeout=BULK_REQUEST_TIMEOUT)
+        success, _ = helpers.bulk(client, actions, chunk_size=len(pairs), pipeline=TIMESTAMP_PIPELINE_ID)
+        return success
+    
+    async def index_chats(self, pairs: List[Tuple[str, str]], provider: str) -> int:
+        if not pairs:
+            return 0
         
-        search_body = {
-            "query": {
-                "script_score": {
-                    "query": {"match_all": {}},
-                    "script": {
-                        "source": "cosineSimilarity(params.query_vector, 'embedding') + 1.0",
-                        "params": {"query_vector": query_embedding}
+        semaphore = asyncio.Semaphore(INDEX_MAX_CONCURRENT_BATCHES)
+        
+        async def embed_batch(batch: List[Tuple[str, str]]) -> List[Dict]:
+            # _embeddings_request already retries retryable errors per request;
+            # re-running the whole batch here would re-embed pairs that succeeded
+            async with semaphore:
+                return await asyncio.to_thread(lambda: list(self._chat_actions(batch, provider)))
+        
+        batches = [
+            pairs[start:start + INDEX_SUB_BATCH_SIZE]
+            for start in range(0, len(pairs), INDEX_SUB_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        actions = [action for batch_actions in results for action in batch_actions]
+        
+        from elasticsearch.helpers import async_bulk
+        client = _async_es().options(retry_on_timeout=False, request_timeout=BULK_REQUEST_TIMEOUT)
+        success, _ = await async_bulk(client, actions, chunk_size=500, pipeline=TIMESTAMP_PIPELINE_ID)
+        return success
+    
+    def _similar_search_body(self, query_embedding: np.ndarray, size: int,
+                             exact: bool = False) -> Dict[str, Any]:
+        # ES rejects k and num_candidates above 10,000
+        size = min(size, KNN_MAX_CANDIDATES)
+        if exact:
+            # Brute-force scoring of every doc, bypassing the approximate HNSW graph
+            return {
+                "query": {
+                    "script_score": {
+                        "query": {"match_all": {}},
+                        "script": {
+                            "id": COSINE_SCRIPT_ID,
+                            "params": {"query_vector": query_embedding}
+                        }
                     }
-                }
+                },
+                "size": size,
+                "timeout": f"{self.latency_target_ms}ms",
+                # Caps docs scored per shard so a growing corpus can't blow the budget
+                "terminate_after": EXACT_SEARCH_MAX_DOCS,
+                "_source": CHAT_SOURCE_FIELDS
+            }
+        return {
+            "knn": {
+                "field": "query_embedding",
+                "query_vector": query_embedding,
+                "k": size,
+                "num_candidates": min(max(50, size * 10), KNN_MAX_CANDIDATES)
             },
             "size": size,
-            "_source": ["timestamp", "provider", "query", "response"]
+            "timeout": f"{self.latency_target_ms}ms",
+            "_source": CHAT_SOURCE_FIELDS
+        }
+    
+    def _recent_search_body(self, size: int) -> Dict[str, Any]:
+        return {
+            "sort": [{"timestamp": "desc"}],
+            "size": size,
+            "_source": CHAT_SOURCE_FIELDS
+        }
+    
+    def _stats_search_body(self) -> Dict[str, Any]:
+        return {
+            "size": 0,
+            "track_total_hits": True,
+            "aggs": {"provider_counts": {"terms": {"field": "provider"}}}
         }
+    
+    def search_similar_chats(self, query: str, size: int = 5, exact: bool = False,
+                             rerank: bool = False) -> List[Dict]:
+        query_embedding = self._get_embedding(query)
+        if rerank:
+            return self._search_reranked(query_embedding, size)
+        search_body = self._similar_search_body(query_embedding, size, exact)
         
-        response = es.search(index=self.index_name, body=search_body)
+        # Until the first chat is indexed the index doesn't exist yet
+        response = es.search(index=self.index_name, body=search_body, ignore_unavailable=True)
         return [hit["_source"] for hit in response["hits"]["hits"]]
     
-    def ask_openai(self, question: str) -> str:
-        completion = openai_client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": question}]
+    def _search_reranked(self, query_embedding: np.ndarray, size: int) -> List[Dict]:
+        # Over-fetch from the int8 ANN index, then re-score the candidates with
+        # full-precision vectors held in process memory
+        search_body = self._similar_search_body(query_embedding, max(size, RERANK_CANDIDATES))
+        hits = es.search(
+            index=self.index_name, body=search_body, ignore_unavailable=True
+        )["hits"]["hits"]
+        
+        ids = [hit["_id"] for hit in hits]
+        missing = self._local_vectors.missing(ids)
+        if missing:
+            docs = es.mget(index=self.index_name, ids=missing, _source=["query_embedding"])["docs"]
+            found = [doc for doc in docs if doc.get("found")]
+            self._local_vectors.add(
+                [doc["_id"] for doc in found],
+                np.asarray([doc["_source"]["query_embedding"] for doc in found], dtype=np.float32)
+            )
+            hits = [hit for hit in hits if not self._local_vectors.missing([hit["_id"]])]
+            ids = [hit["_id"] for hit in hits]
+        if not hits:
+            return []
+        
+        top, _ = cosine_topk(query_embedding, self._local_vectors.vectors(ids), size)
+        return [hits[i]["_source"] for i in top]
+    
+    def search_history(self, query: Optional[str] = None, size: int = 5,
+                       recent_size: int = 0, include_stats: bool = False) -> Dict[str, Any]:
+        # Similarity, recent-history and stats lookups share one _msearch round-trip
+        bodies = {}
+        if query:
+            bodies["similar"] = self._similar_search_body(self._get_embedding(query), size)
+        if recent_size:
+            bodies["recent"] = self._recent_search_body(recent_size)
+        if include_stats:
+            bodies["stats"] = self._stats_search_body()
+        if not bodies:
+            return {}
+        
+        searches = []
+        for body in bodies.values():
+            searches.extend([{}, body])
+        responses = es.msearch(
+            index=self.index_name, searches=searches, ignore_unavailable=True
+        )["responses"]
+        
+        results = {}
+        for name, response in zip(bodies, responses):
+            if "error" in response:
+                raise RuntimeError(f"{name} search failed: {response['error']}")
+            if name == "stats":
+                # No aggregations come back while the index hasn't been created
+                aggs = response.get("aggregations", {})
+                buckets = aggs.get("provider_counts", {}).get("buckets", [])
+                results[name] = {
+                    "total": response["hits"]["total"]["value"],
+                    "providers": {bucket["key"]: bucket["doc_count"] for bucket in buckets}
+                }
+            else:
+                results[name] = [hit["_source"] for hit in response["hits"]["hits"]]
+        return results
+    
+    def get_recent_chats(self, size: int = 10) -> List[Dict]:
+        return self.search_history(recent_size=size)["recent"]
+    
+    def get_chat_stats(self) -> Dict[str, Any]:
+        return self.search_history(include_stats=True)["stats"]
+    
+    async def _call_provider(self, profile: ProviderProfile, make_request, tokens_estimate: int,
+                             hold_semaphore: bool = True):
+        # Callers that consume a streamed body pass hold_semaphore=False and hold
+        # the provider's semaphore themselves until the stream is drained
+        limiter = self._rate_limiters[profile.name]
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            await limiter.acquire(tokens_estimate)
+            try:
+                if hold_semaphore:
+                    async with self._semaphores[profile.name]:
+                        result = await make_request()
+                else:
+                    result = await make_request()
+            except Exception as e:
+                if not await self._backoff(profile, e, attempt):
+                    raise
+            else:
+                limiter.on_success()
+                return result
+    
+    async def _backoff(self, profile: ProviderProfile, exc: Exception, attempt: int) -> bool:
+        # Sleeps before the next attempt; returns False when exc shouldn't be retried
+        status = _status_code(exc)
+        if status not in profile.retryable or attempt == RATE_LIMIT_MAX_RETRIES:
+            return False
+        if status == 429:
+            self._rate_limiters[profile.name].on_rate_limited(*_reported_limits(exc))
+        delay = _retry_after_seconds(exc) or 2 ** attempt + random.uniform(0, 1)
+        await asyncio.sleep(delay)
+        return True
+    
+    async def _index_chat_async(self, query: str, response: str, provider: str):
+        try:
+            await asyncio.to_thread(self.index_chat, query, response, provider)
+        except Exception:
+            logger.exception("Failed to index %s chat", provider)
+    
+    def _schedule_index(self, query: str, response: str, provider: str):
+        task = asyncio.create_task(self._index_chat_async(query, response, provider))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def flush(self):
+        # Wait for chats handed off to background indexing to reach Elasticsearch
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks)
+    
+    async def aclose(self):
+        # Call before the event loop exits: finishes pending indexing and closes
+        # the async clients so the manager can be reused under a later loop
+        await self.flush()
+        await _close_async_clients()
+        self._semaphores = self._new_semaphores()
+    
+    def _new_semaphores(self) -> Dict[str, asyncio.Semaphore]:
+        return {
+            name: asyncio.Semaphore(profile.max_concurrent)
+            for name, profile in PROFILES.items()
+        }
+    
+    async def _openai_deltas(self, profile: ProviderProfile, question: str) -> AsyncIterator[str]:
+        # The generation is in flight until the stream is drained, so the
+        # concurrency slot is held for the whole read, not just the request
+        async with self._semaphores[profile.name]:
+            for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+                stream = await self._call_provider(
+                    profile,
+                    lambda: _async_openai().chat.completions.create(
+                        model=profile.model,
+                        messages=[{"role": "user", "content": question}],
+                        stream=True
+                    ),
+                    _estimate_tokens(question) + COMPLETION_TOKEN_ESTIMATE,
+                    hold_semaphore=False
+                )
+                started = False
+                try:
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            started = True
+                            yield chunk.choices[0].delta.content
+                    return
+                except Exception as e:
+                    # Deltas already handed to the caller can't be taken back
+                    if started or not await self._backoff(profile, e, attempt):
+                        raise
+    
+    async def _ask_openai(self, profile: ProviderProfile, question: str) -> str:
+        return "".join([delta async for delta in self._openai_deltas(profile, question)])
+    
+    async def _ask_anthropic(self, profile: ProviderProfile, question: str) -> str:
+        message = await self._call_provider(
+            profile,
+            lambda: _anthropic().messages.create(
+                model=profile.model,
+                max_tokens=4000,
+                messages=[{"role": "user", "content": question}]
+            ),
+            _estimate_tokens(question) + COMPLETION_TOKEN_ESTIMATE
         )
-        response = completion.choices[0].message.content
-        self.index_chat(question, response, "openai")
-        return response
+        return message.content[0].text
     
-    def ask_anthropic(self, question: str) -> str:
-        message = anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=4000,
-            messages=[{"role": "user", "content": question}]
+    async def _ask_google(self, profile: ProviderProfile, question: str) -> str:
+        model = _genai().GenerativeModel(profile.model)
+        response = await self._call_provider(
+            profile,
+            lambda: model.generate_content_async(question),
+            _estimate_tokens(question) + COMPLETION_TOKEN_ESTIMATE
         )
-        response = message.content[0].text
-        self.index_chat(question, response, "anthropic")
+        return response.text
+    
+    async def ask(self, provider: str, question: str) -> str:
+        if provider not in PROFILES:
+            raise ValueError(f"Unknown provider: {provider}")
+        response = await self._ask_handlers[provider](PROFILES[provider], question)
+        self._schedule_index(question, response, provider)
         return response
     
-    def ask_google(self, question: str) -> str:
-        model = genai.GenerativeModel('gemini-pro')
-        response = model.generate_content(question)
-        response_text = response.text
-        self.index_chat(question, response_text, "google")
-        return response_text
+    async def stream_openai(self, question: str) -> AsyncIterator[str]:
+        chunks = []
+        async for delta in self._openai_deltas(PROFILES["openai"], question):
+            chunks.append(delta)
+            yield delta
+        self._schedule_index(question, "".join(chunks), "openai")
+    
+    async def ask_openai(self, question: str) -> str:
+        return await self.ask("openai", question)
+    
+    async def ask_anthropic(self, question: str) -> str:
+        return await self.ask("anthropic", question)
+    
+    async def ask_google(self, question: str) -> str:
+        return await self.ask("google", question)
 
-if __name__ == "__main__":
+async def main():
     manager = ChatHistoryManager()
+    manager.setup_index()
     
     q = "How do I configure my ingest pipeline?"
     print(f"Question: {q}")
     
     # Test OpenAI
     print("\n--- OpenAI Response ---")
-    openai_answer = manager.ask_openai(q)
-    print(openai_answer)
+    async for delta in manager.stream_openai(q):
+        print(delta, end="", flush=True)
+    print()
+    await manager.flush()
     
     # Search for similar past conversations
     print("\n--- Similar Past Conversations ---")
@@ -128,4 +972,13 @@ if __name__ == "__main__":
     for i, chat in enumerate(similar, 1):
         print(f"{i}. [{chat['provider']}] {chat['query'][:50]}...")
         print(f"   {chat['response'][:100]}...")
-        print()
\ No newline at end of file
+        print()
+    
+    await manager.aclose()
+
+if __name__ == "__main__":
+    if "--setup" in sys.argv[1:]:
+        # Registers the template, pipeline and script without running the demo
+        ChatHistoryManager().setup_index()
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -15,7 +15,8 @@ from mcp.types import (
     LoggingLevel
 )
 from pydantic import AnyUrl
-from chat_history import ChatHistoryManager
+from elasticsearch import AuthorizationException
+from chat_history import ChatHistoryManager, PROFILES
 
 server = Server("chat-history-server")
 chat_manager = ChatHistoryManager()
@@ -35,7 +36,7 @@ async def handle_list_resources() -> list[Resource]:
 async def handle_read_resource(uri: AnyUrl) -> str:
     if str(uri) == "chat://history":
         # Return recent chat history
-        recent_chats = chat_manager.search_similar_chats("", size=10)
+        recent_chats = chat_manager.get_recent_chats(size=10)
         return json.dumps(recent_chats, indent=2)
     else:
         raise ValueError(f"Unknown resource: {uri}")
@@ -75,7 +76,7 @@ async def handle_list_tools() -> list[Tool]:
                     "provider": {
                         "type": "string",
                         "description": "LLM provider to use",
-                        "enum": ["openai", "anthropic", "google"],
+                        "enum": list(PROFILES),
                         "default": "openai"
                     }
                 },
@@ -84,7 +85,7 @@ async def handle_list_tools() -> list[Tool]:
         ),
         Tool(
             name="get_chat_stats",
-            description="Get statistics about stored chat history",
+            description="Get statistics and the most recent questions from stored chat history",
             inputSchema={
                 "type": "object",
                 "properties": {},
@@ -99,20 +100,28 @@ async def handle_call_tool(name: str, arguments: dict[str, Any] | None) -> list[
     
     if name == "search_chat_history":
         query = arguments.get("query", "")
-        limit = arguments.get("limit", 5)
+        try:
+            limit = int(arguments.get("limit", 5))
+        except (TypeError, ValueError):
+            return [TextContent(type="text", text="limit must be a number.")]
+        if limit < 1:
+            return [TextContent(type="text", text="limit must be at least 1.")]
         
         results = chat_manager.search_similar_chats(query, size=limit)
         
         if not results:
             return [TextContent(type="text", text="No similar conversations found.")]
         
-        response_text = f"Found {len(results)} similar conversations:\n\n"
+        lines = [f"Found {len(results)} similar conversations:", ""]
         for i, chat in enumerate(results, 1):
-            response_text += f"{i}. **[{chat['provider'].upper()}]** {chat['timestamp']}\n"
-            response_text += f"   **Q:** {chat['query']}\n"
-            response_text += f"   **A:** {chat['response'][:200]}{'...' if len(chat['response']) > 200 else ''}\n\n"
+            answer = chat['response']
+            ellipsis = "..." if len(answer) > 200 else ""
+            lines.append(f"{i}. **[{chat['provider'].upper()}]** {chat['timestamp']}")
+            lines.append(f"   **Q:** {chat['query']}")
+            lines.append(f"   **A:** {answer[:200]}{ellipsis}")
+            lines.append("")
         
-        return [TextContent(type="text", text=response_text)]
+        return [TextContent(type="text", text="\n".join(lines) + "\n")]
     
     elif name == "ask_llm":
         question = arguments.get("question", "")
@@ -121,15 +130,11 @@ async def handle_call_tool(name: str, arguments: dict[str, Any] | None) -> list[
         if not question:
             return [TextContent(type="text", text="Please provide a question to ask.")]
         
+        if provider not in PROFILES:
+            return [TextContent(type="text", text=f"Unknown provider: {provider}")]
+        
         try:
-            if provider == "openai":
-                response = chat_manager.ask_openai(question)
-            elif provider == "anthropic":
-                response = chat_manager.ask_anthropic(question)
-            elif provider == "google":
-                response = chat_manager.ask_google(question)
-            else:
-                return [TextContent(type="text", text=f"Unknown provider: {provider}")]
+            response = await chat_manager.ask(provider, question)
             
             return [TextContent(type="text", text=f"**Question:** {question}\n\n**Response from {provider.upper()}:**\n{response}")]
         except Exception as e:
@@ -137,34 +142,18 @@ async def handle_call_tool(name: str, arguments: dict[str, Any] | None) -> list[
     
     elif name == "get_chat_stats":
         try:
-            # Get total count from Elasticsearch
-            from elasticsearch import Elasticsearch
-            import os
-            es = Elasticsearch(
-                os.getenv("ELASTICSEARCH_URL"),
-                api_key=os.getenv("ELASTICSEARCH_API_KEY")
-            )
-            
-            stats_query = {
-                "aggs": {
-                    "provider_counts": {
-                        "terms": {
-                            "field": "provider"
-                        }
-                    }
-                },
-                "size": 0
-            }
-            
-            response = es.search(index="chat_history", body=stats_query)
-            total_chats = response['hits']['total']['value']
-            provider_stats = response['aggregations']['provider_counts']['buckets']
+            # Stats and the latest questions come back from a single msearch
+            history = chat_manager.search_history(recent_size=5, include_stats=True)
+            stats = history["stats"]
             
             stats_text = f"**Chat History Statistics:**\n\n"
-            stats_text += f"Total conversations: {total_chats}\n\n"
+            stats_text += f"Total conversations: {stats['total']}\n\n"
             stats_text += "**By Provider:**\n"
-            for provider in provider_stats:
-                stats_text += f"- {provider['key'].upper()}: {provider['doc_count']}\n"
+            for provider, count in stats["providers"].items():
+                stats_text += f"- {provider.upper()}: {count}\n"
+            stats_text += "\n**Most Recent:**\n"
+            for chat in history["recent"]:
+                stats_text += f"- [{chat['provider'].upper()}] {chat['query'][:100]}\n"
             
             return [TextContent(type="text", text=stats_text)]
         except Exception as e:
@@ -174,20 +163,30 @@ async def handle_call_tool(name: str, arguments: dict[str, Any] | None) -> list[
         raise ValueError(f"Unknown tool: {name}")
 
 async def main():
+    # Every write goes through the timestamp pipeline, so make sure it exists.
+    # Index-scoped keys can't register it; that is left to `chat_history.py --setup`
+    try:
+        chat_manager.setup_index()
+    except AuthorizationException:
+        pass
+    
     # Run the server using stdin/stdout streams
-    async with stdio_server() as (read_stream, write_stream):
-        await server.run(
-            read_stream,
-            write_stream,
-            InitializationOptions(
-                server_name="chat-history-server",
-                server_version="0.1.0",
-                capabilities=server.get_capabilities(
-                    notification_options=NotificationOptions(),
-                    experimental_capabilities={},
+    try:
+        async with stdio_server() as (read_stream, write_stream):
+            await server.run(
+                read_stream,
+                write_stream,
+                InitializationOptions(
+                    server_name="chat-history-server",
+                    server_version="0.1.0",
+                    capabilities=server.get_capabilities(
+                        notification_options=NotificationOptions(),
+                        experimental_capabilities={},
+                    ),
                 ),
-            ),
-        )
+            )
+    finally:
+        await chat_manager.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -55,8 +55,9 @@ def main():
     print("\n✅ Setup complete!")
     print("\nNext steps:")
     print("1. Edit .env file with your API keys")
-    print("2. Run: python chat_history.py")
-    print("3. For MCP server: python mcp_server.py")
+    print("2. Run: python chat_history.py --setup (registers the Elasticsearch index template once)")
+    print("3. Run: python chat_history.py")
+    print("4. For MCP server: python mcp_server.py")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file